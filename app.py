@@ -1,11 +1,27 @@
-# app.py — versão limpa (sem escrever arquivos locais)
+# app.py — versão limpa (único arquivo local: cache de payloads em CNPJ_CACHE_DIR)
+import csv
+import functools
+import hashlib
+import io
+import operator
 import os
 import re
-from typing import List, Dict, Any, Tuple, Optional
-
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+from types import SimpleNamespace
+from typing import List, Dict, Any, Iterator, Tuple, Optional
+
+import numpy as np
+import orjson
 import requests
 import pandas as pd
 import streamlit as st
+from diskcache import Cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # ========= Config =========
 st.set_page_config(page_title="Quem pode assinar? • CNPJ", layout="wide")
@@ -19,6 +35,25 @@ GATEWAY_URL = os.getenv("GATEWAY_URL")
 INTERNAL_API_KEY = os.getenv("INTERNAL_API_KEY")
 ENABLE_ALT_PROVIDERS = os.getenv("ENABLE_ALT_PROVIDERS", "1") not in ("0", "false", "False")
 RECEITAWS_TOKEN = os.getenv("RECEITAWS_TOKEN")  # opcional
+GATEWAY_CACHE_TTL = 24*3600
+
+# Lote: consultas em paralelo (I/O de rede); a BrasilAPI pública tem limite de taxa
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "8"))
+BRASILAPI_RPS = float(os.getenv("BRASILAPI_RPS", "3"))
+BRASILAPI_BURST = 10
+BATCH_COLUMNS = ["cnpj","razao_social","uf","municipio","porte","entidade_publica",
+                 "provaveis_assinantes","fonte","junta_url","erro"]
+BATCH_REFRESH_EVERY = 50   # atualiza a prévia da tabela a cada N CNPJs concluídos
+BATCH_PREVIEW_ROWS = 200
+BATCH_PROGRESS_EVERY = 0.2  # s entre atualizações da barra (cada uma é uma ida ao navegador)
+BATCH_CHUNK_ROWS = 1000    # linhas do CSV lidas por vez
+INVALID_DV_ERROR = "checksum inválido (dígitos verificadores)"
+
+# Cache em disco dos payloads (sobrevive a restarts/redeploys; Receita atualiza ~mensalmente)
+CACHE_DIR = os.getenv("CNPJ_CACHE_DIR", "/tmp/cnpj_cache")
+DISK_CACHE_TTL = 7*24*3600
+STALE_TTL = 30*24*3600      # última resposta boa, servida se o provedor falhar (stale-if-error)
+MEMORY_CACHE_ENTRIES = 10000  # teto do st.cache_data por fetcher
 
 LIKELY_SIGNER_KEYWORDS = [
     "administrador","administradora","sócio-administrador","sócio administrador",
@@ -37,35 +72,84 @@ JUNTAS_BY_UF = {
     "RR":"https://www.jucerr.rr.gov.br/","RS":"https://www.jucisrs.rs.gov.br/","SC":"https://www.jucesc.sc.gov.br/",
     "SE":"https://www.jucese.se.gov.br/","SP":"https://www.jucesp.sp.gov.br/","TO":"https://www.jucetins.to.gov.br/",
 }
+# Todas as grafias de caixa de cada UF ("SP", "sp", "Sp", "sP"): a busca não precisa de .upper()
+_JUNTAS_LOOKUP = {a+b: url for uf,url in JUNTAS_BY_UF.items()
+                  for a in (uf[0], uf[0].lower()) for b in (uf[1], uf[1].lower())}
 DIARIO_OFICIAL_HINTS = {
     "SP":{"municipal":"https://www.imprensaoficial.com.br/","estadual":"https://www.imprensaoficial.com.br/",
           "transparencia_municipio":"https://transparencia.prefeitura.sp.gov.br/"}
 }
 
+# O Streamlit reexecuta este arquivo a cada interação. Os dicts acima são literais baratos; o que custa
+# montar (SQLite do cache em disco, regex, tabela do translate) sai daqui uma vez por processo.
+@st.cache_resource
+def load_constants() -> SimpleNamespace:
+    # A lista fica como documentação; a regex usa só os termos mínimos ("diretora" já casa com "diretor")
+    terms = [k for k in LIKELY_SIGNER_KEYWORDS if not any(o != k and o in k for o in LIKELY_SIGNER_KEYWORDS)]
+    return SimpleNamespace(
+        cache=Cache(CACHE_DIR, size_limit=2**30),
+        signer_re=re.compile("|".join(map(re.escape, terms)), re.IGNORECASE),
+        non_digits_re=re.compile(r"\D+"),
+        # Latin-1 + "General Punctuation" (U+2000–206F: travessões e espaços finos de texto colado de PDF)
+        non_digit_trans=str.maketrans("", "", "".join(chr(c) for c in [*range(256), *range(0x2000, 0x2070)]
+                                                      if not chr(c).isdecimal())),
+    )
+
+_K = load_constants()
+CACHE = _K.cache
+_SIGNER_RE = _K.signer_re
+_NON_DIGITS_RE = _K.non_digits_re
+_NON_DIGIT_TRANS = _K.non_digit_trans
+
 # ========= Utils =========
 def only_digits(s: str) -> str:
-    return re.sub(r"\D+", "", s or "")
+    if not s or s.isdecimal(): return s or ""
+    # translate cobre as máscaras usuais; regex só se sobrar algo fora dessas faixas
+    t = s.translate(_NON_DIGIT_TRANS)
+    return t if not t or t.isdecimal() else _NON_DIGITS_RE.sub("", t)
 
 def cnpj_format(digits14: str) -> str:
     d = only_digits(digits14).zfill(14)
     return f"{d[0:2]}.{d[2:5]}.{d[5:8]}/{d[8:12]}-{d[12:14]}"
 
+_W12 = (5,4,3,2,9,8,7,6,5,4,3,2)
+_W13 = (6,5,4,3,2,9,8,7,6,5,4,3,2)
+_W12_NP = np.array(_W12, dtype=np.int64)
+_W13_NP = np.array(_W13, dtype=np.int64)
+
+# Soma dos pesos × ord("0"): tira o deslocamento ASCII de uma vez em vez de int() por dígito
+_W12_ZERO = 48*sum(_W12)
+_W13_ZERO = 48*sum(_W13)
+
+def _dv(digits: bytes, ws: Tuple[int,...], zero: int) -> int:
+    # map para no fim dos pesos: com _W12 usa os 12 primeiros bytes, com _W13 os 13
+    r = (sum(map(operator.mul, digits, ws)) - zero) % 11
+    return 0 if r<2 else 11-r
+
 def cnpj_is_valid(cnpj: str) -> bool:
     d = only_digits(cnpj)
-    if len(d) != 14 or d == d[0]*14: return False
-    def calc(nums: str) -> str:
-        w12=[5,4,3,2,9,8,7,6,5,4,3,2]; w13=[6,5,4,3,2,9,8,7,6,5,4,3,2]
-        ws = w12 if len(nums)==12 else w13
-        s = sum(int(n)*w for n,w in zip(nums,ws)); r=s%11
-        return "0" if r<2 else str(11-r)
-    d1=calc(d[:12]); d2=calc(d[:12]+d1)
-    return d[-2:]==d1+d2
+    if len(d) != 14 or not d.isascii() or d == d[0]*14: return False
+    b = d.encode()
+    # o 2º DV só é conferido se o 1º bateu, logo b[:13] já é base + DV1
+    return b[12]-48 == _dv(b, _W12, _W12_ZERO) and b[13]-48 == _dv(b, _W13, _W13_ZERO)
+
+def cnpj_digit_matrix(cnpjs: List[str]) -> np.ndarray:
+    """Empilha CNPJs de 14 dígitos ASCII numa matriz (N, 14) de dígitos."""
+    return (np.frombuffer("".join(cnpjs).encode("ascii"), dtype=np.uint8).reshape(-1, 14) - 48).astype(np.int8)
+
+def cnpj_is_valid_batch(digits_arr: np.ndarray) -> np.ndarray:
+    """Versão vetorizada de cnpj_is_valid: recebe (N, 14) dígitos e devolve máscara booleana (N,)."""
+    d = digits_arr.astype(np.int64)
+    r1 = (d[:, :12] @ _W12_NP) % 11; d1 = np.where(r1 < 2, 0, 11 - r1)
+    r2 = (d[:, :12] @ _W13_NP[:12] + d1 * _W13_NP[12]) % 11; d2 = np.where(r2 < 2, 0, 11 - r2)
+    repeated = (d == d[:, :1]).all(axis=1)
+    return (d[:, 12] == d1) & (d[:, 13] == d2) & ~repeated
 
 def short_join(vs: List[str], sep: str=", ")->str:
     return sep.join([v for v in vs if v])
 
 def get_junta_url(uf: Optional[str]) -> str:
-    return JUNTAS_BY_UF.get((uf or "").upper(),"") if uf else ""
+    return _JUNTAS_LOOKUP.get(uf, "") if uf else ""
 
 def is_public_entity(natureza: Optional[str], code: Optional[str]) -> bool:
     if code and str(code).startswith("1"): return True
@@ -73,35 +157,167 @@ def is_public_entity(natureza: Optional[str], code: Optional[str]) -> bool:
     return False
 
 def extract_likely_signers(qsa: List[Dict[str,Any]]) -> List[Dict[str,Any]]:
-    out=[]
-    for it in qsa or []:
-        nome = it.get("nome_socio") or it.get("nome") or it.get("nome_rep_legal") or ""
-        qual = it.get("qualificacao_socio") or it.get("qualificacao") or it.get("qual") or ""
-        cargo = (qual or "").lower().strip()
-        out.append({"nome": nome or "(sem nome)", "qualificacao": qual or "(sem qualificação)",
-                    "provavel_assinante": any(k in cargo for k in LIKELY_SIGNER_KEYWORDS)})
-    return out
+    search = _SIGNER_RE.search  # IGNORECASE: dispensa .lower() por sócio
+    return [{"nome": get("nome_socio") or get("nome") or get("nome_rep_legal") or "(sem nome)",
+             "qualificacao": (qual := get("qualificacao_socio") or get("qualificacao") or get("qual") or "") or "(sem qualificação)",
+             "provavel_assinante": bool(search(qual))}
+            for get in (it.get for it in qsa or [])]
 
 # ========= Data fetchers =========
-@st.cache_data(ttl=3600, show_spinner=False)
-def fetch_via_gateway(cnpj: str)->Dict[str,Any]:
-    if not (GATEWAY_URL and INTERNAL_API_KEY):
-        raise RuntimeError("Gateway não configurado")
-    r = requests.get(f"{GATEWAY_URL.rstrip('/')}/cnpj/{cnpj}/qsa",
-                     headers={"X-API-Key": INTERNAL_API_KEY}, timeout=30)
-    r.raise_for_status(); return r.json()
+class TokenBucket:
+    """Limitador de taxa thread-safe: `rate` chamadas/s, com rajada de até `burst`."""
+    def __init__(self, rate: float, burst: int):
+        self.rate=rate; self.capacity=float(burst); self.tokens=float(burst)
+        self.updated=time.monotonic(); self.lock=threading.Lock()
+
+    def acquire(self, deadline: Optional[float]=None) -> None:
+        """Espera uma ficha; levanta TimeoutError logo se a espera passaria de `deadline` (monotonic)."""
+        while True:
+            with self.lock:
+                now=time.monotonic()
+                self.tokens=min(self.capacity, self.tokens+(now-self.updated)*self.rate); self.updated=now
+                if self.tokens>=1:
+                    self.tokens-=1; return
+                delay=(1-self.tokens)/self.rate
+            if deadline is not None and now+delay >= deadline:
+                raise TimeoutError(f"limite de taxa: {DEADLINE_ERROR}")
+            time.sleep(delay)
+
+@st.cache_resource
+def brasilapi_bucket() -> TokenBucket:
+    # cache_resource: um único balde por processo, compartilhado entre sessões e reruns
+    return TokenBucket(BRASILAPI_RPS, BRASILAPI_BURST)
+
+# (connect, read): host fora do ar falha rápido e a cascata segue; leitura ajustável no sidebar
+HTTP_CONNECT_TIMEOUT = 3.05
+HTTP_READ_TIMEOUT = 8
+HTTP_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+# Teto (s) da cascata inteira por CNPJ: corta timeouts de socket e a espera pelo balde da BrasilAPI.
+# Fica de fora só um retry do urllib3 já iniciado (backoff + Retry-After ≤ RETRY_AFTER_MAX e uma tentativa).
+TRY_ALL_DEADLINE = 15
+DEADLINE_ERROR = "prazo total da consulta esgotado"
+RETRY_AFTER_MAX = 2.0  # s; ReceitaWS gratuita manda Retry-After de minutos
+# Consulta única: se o provedor público não responder nesse prazo, o alternativo dispara em paralelo
+HEDGE_DELAY = 1.0
+HEDGE_PAIR = {"brasilapi", "receitaws"}
+HEDGE_WORKERS = 8
+
+class CappedRetry(Retry):
+    """Retry que respeita Retry-After só até RETRY_AFTER_MAX; acima disso o worker não fica parado."""
+    def get_retry_after(self, response) -> Optional[float]:
+        after = super().get_retry_after(response)
+        return None if after is None else min(after, RETRY_AFTER_MAX)
+
+# Sessão compartilhada: reaproveita conexões (keep-alive) e refaz falhas transitórias uma vez.
+# Leitura estourada não é refeita: o timeout de leitura já vem cortado pelo prazo da cascata.
+# Um pool por host (gateway, BrasilAPI, ReceitaWS) com uma conexão por worker do lote e do hedge,
+# para a consulta única não ficar na fila atrás de um lote em andamento.
+# Sem pool_block: com vários lotes em sessões diferentes, o excedente abre uma conexão extra
+# (descartada ao devolver) em vez de esperar por uma livre sem prazo nenhum.
+@st.cache_resource
+def get_session() -> requests.Session:
+    # cache_resource: o script roda de novo a cada interação; a sessão (e o pool) sobrevive
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=3, pool_maxsize=BATCH_WORKERS+HEDGE_WORKERS, pool_block=False,
+                          max_retries=CappedRetry(total=1, read=0, backoff_factor=0.2,
+                                                  status_forcelist=[429,500,502,503,504],
+                                                  allowed_methods={"GET"}, respect_retry_after_header=True))
+    session.mount("https://", adapter); session.mount("http://", adapter)
+    session.headers.update({"User-Agent": "quem-assina-cnpj/1.0", "Accept": "application/json",
+                            "Accept-Encoding": "gzip, deflate"})
+    return session
+
+def checked_payload(payload: Any, keys: Tuple[str,...], provider: str) -> Dict[str,Any]:
+    """Devolve o payload só se tiver algum dos campos esperados; senão levanta (e nada é cacheado)."""
+    if isinstance(payload, dict) and any(k in payload for k in keys): return payload
+    msg = payload.get("message") if isinstance(payload, dict) else None
+    raise RuntimeError(f"{provider} retornou payload sem dados do CNPJ" + (f": {msg}" if msg else ""))
+
+# Campos lidos pela tela/CSV; o resto do payload não vai para os caches
+RAW_FIELDS = ("razao_social","nome_fantasia","nome","porte","natureza_juridica","natureza_juridica_codigo")
+EST_FIELDS = ("estado","uf","estado_nf","cidade","municipio","cep","tipo_logradouro","logradouro","numero","complemento")
+QSA_FIELDS = ("nome_socio","nome","nome_rep_legal","qualificacao_socio","qualificacao","qual")
+RECEITAWS_FIELDS = ("nome","porte","uf","estado","municipio","cep")
+
+def stale_key(provider: str, cnpj: str, **kw: str) -> Tuple[Any,...]:
+    # kw: argumentos de cache do provedor (gateway_url/api_key_hash), como na chave do payload
+    return ("stale", provider, cnpj, *sorted(kw.items()))
+
+def keep_stale(key: Tuple[Any,...], payload: Dict[str,Any]) -> Dict[str,Any]:
+    CACHE.set(key, payload, expire=STALE_TTL); return payload
+
+def pick(d: Dict[str,Any], keys: Tuple[str,...]) -> Dict[str,Any]:
+    return {k: d[k] for k in keys if d.get(k) is not None}
+
+def slim_payload(raw: Dict[str,Any], fields: Tuple[str,...]=RAW_FIELDS,
+                 est_fields: Tuple[str,...]=EST_FIELDS) -> Dict[str,Any]:
+    """Projeta o payload nos campos usados; endereço no topo (BrasilAPI) vira `estabelecimento`."""
+    out = pick(raw, fields)
+    est = raw.get("estabelecimento")
+    est = pick(est if isinstance(est, dict) else raw, est_fields)
+    if est: out["estabelecimento"] = est
+    qsa = raw.get("qsa") or raw.get("socios")
+    if qsa: out["qsa"] = [pick(i, QSA_FIELDS) for i in qsa if isinstance(i, dict)]
+    return out
 
-@st.cache_data(ttl=3600, show_spinner=False)
-def fetch_brasilapi(cnpj: str)->Dict[str,Any]:
-    r = requests.get(f"https://brasilapi.com.br/api/cnpj/v1/{cnpj}", timeout=30)
-    r.raise_for_status(); return r.json()
+# URL e hash da chave entram na chave de cache: trocar gateway/rotacionar a chave não serve resposta velha
+GATEWAY_ARGS = {"gateway_url": GATEWAY_URL or "",
+                "api_key_hash": hashlib.sha256(INTERNAL_API_KEY.encode()).hexdigest()[:8] if INTERNAL_API_KEY else ""}
 
-@st.cache_data(ttl=3600, show_spinner=False)
-def fetch_receitaws(cnpj: str)->Dict[str,Any]:
+@st.cache_data(ttl=GATEWAY_CACHE_TTL, show_spinner=False, max_entries=MEMORY_CACHE_ENTRIES)
+@CACHE.memoize(expire=GATEWAY_CACHE_TTL, ignore=("_timeout","_deadline"))
+def fetch_via_gateway(cnpj: str, gateway_url: str, api_key_hash: str,
+                      _timeout: Tuple[float,float]=HTTP_TIMEOUT, _deadline: Optional[float]=None)->Dict[str,Any]:
+    # api_key_hash só diferencia o cache; a chave real vem do ambiente
+    if not (gateway_url and INTERNAL_API_KEY):
+        raise RuntimeError("Gateway não configurado")
+    r = get_session().get(f"{gateway_url.rstrip('/')}/cnpj/{cnpj}/qsa",
+                          headers={"X-API-Key": INTERNAL_API_KEY}, timeout=_timeout)
+    r.raise_for_status(); payload = checked_payload(orjson.loads(r.content), ("qsa","raw"), "Gateway")
+    out = {"raw": slim_payload(payload.get("raw") or {})}
+    if payload.get("qsa"): out["qsa"] = [pick(i, QSA_FIELDS) for i in payload["qsa"] if isinstance(i, dict)]
+    return keep_stale(stale_key("gateway", cnpj, gateway_url=gateway_url, api_key_hash=api_key_hash), out)
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=MEMORY_CACHE_ENTRIES)
+@CACHE.memoize(expire=DISK_CACHE_TTL, ignore=("_timeout","_deadline"))
+def fetch_brasilapi(cnpj: str, _timeout: Tuple[float,float]=HTTP_TIMEOUT,
+                    _deadline: Optional[float]=None)->Dict[str,Any]:
+    brasilapi_bucket().acquire(_deadline)
+    # A espera pelo balde já gastou parte do prazo
+    if not (_timeout := budget(_timeout, _deadline)): raise TimeoutError(DEADLINE_ERROR)
+    r = get_session().get(f"https://brasilapi.com.br/api/cnpj/v1/{cnpj}", timeout=_timeout)
+    r.raise_for_status()
+    return keep_stale(stale_key("brasilapi", cnpj),
+                      slim_payload(checked_payload(orjson.loads(r.content), ("razao_social","qsa"), "BrasilAPI")))
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=MEMORY_CACHE_ENTRIES)
+@CACHE.memoize(expire=DISK_CACHE_TTL, ignore=("_timeout","_deadline"))
+def fetch_receitaws(cnpj: str, _timeout: Tuple[float,float]=HTTP_TIMEOUT,
+                    _deadline: Optional[float]=None)->Dict[str,Any]:
     url=f"https://www.receitaws.com.br/v1/cnpj/{cnpj}"
     params = {"token": RECEITAWS_TOKEN} if RECEITAWS_TOKEN else {}
-    r = requests.get(url, params=params, timeout=40)
-    r.raise_for_status(); return r.json()
+    r = get_session().get(url, params=params, timeout=_timeout)
+    r.raise_for_status()
+    return keep_stale(stale_key("receitaws", cnpj),
+                      slim_payload(checked_payload(orjson.loads(r.content), ("nome","qsa"), "ReceitaWS"), RECEITAWS_FIELDS, ()))
+
+# Bureau (ex.: Serasa) via gateway — ilustrativo; schema depende do contrato. Sem cache em disco.
+@st.cache_data(ttl=900, show_spinner=False)
+def fetch_bureau_serasa(cnpj: str, gateway_url: str, api_key_hash: str,
+                        _timeout: Tuple[float,float]=HTTP_TIMEOUT)->Optional[Dict[str,Any]]:
+    if not (gateway_url and INTERNAL_API_KEY): return None
+    r = get_session().get(f"{gateway_url.rstrip('/')}/pj/{cnpj}/bureau/serasa",
+                          headers={"X-API-Key": INTERNAL_API_KEY}, timeout=_timeout)
+    if r.status_code == 404: return None
+    r.raise_for_status(); return orjson.loads(r.content)
+
+def forget_cnpj(cnpj: str) -> None:
+    """Descarta o CNPJ do cache em disco (payloads, cópias antigas e provedor preferido) e limpa o cache em memória."""
+    for name,fn,kw in (("gateway", fetch_via_gateway, GATEWAY_ARGS), ("brasilapi", fetch_brasilapi, {}),
+                       ("receitaws", fetch_receitaws, {})):
+        CACHE.delete(fn.__wrapped__.__cache_key__(cnpj, **kw)); CACHE.delete(stale_key(name, cnpj, **kw))
+        fn.clear(cnpj, **kw)
+    CACHE.delete(("pref", cnpj))
 
 def norm_gateway(payload: Dict[str,Any])->Tuple[Dict[str,Any],List[Dict[str,Any]]]:
     raw = payload.get("raw") or {}
@@ -114,7 +330,7 @@ def norm_brasilapi(raw: Dict[str,Any])->Tuple[Dict[str,Any],List[Dict[str,Any]]]
 
 def norm_receitaws(raw: Dict[str,Any])->Tuple[Dict[str,Any],List[Dict[str,Any]]]:
     qsa = raw.get("qsa") or []
-    qsa_norm = [{"nome": i.get("nome"), "qualificacao": i.get("qual")} for i in qsa]
+    qsa_norm = [{"nome": get("nome"), "qualificacao": get("qual")} for get in (i.get for i in qsa)]
     base = {"razao_social": raw.get("nome"),
             "porte": raw.get("porte"),
             "estabelecimento": {"estado": raw.get("uf") or raw.get("estado"),
@@ -122,24 +338,108 @@ def norm_receitaws(raw: Dict[str,Any])->Tuple[Dict[str,Any],List[Dict[str,Any]]]
                                 "cep": raw.get("cep")}}
     return base, qsa_norm
 
-def try_all(cnpj: str, try_alts: bool)->Tuple[Dict[str,Any],List[Dict[str,Any]],str,Dict[str,str]]:
-    errors={}
-    if GATEWAY_URL and INTERNAL_API_KEY:
-        try:
-            raw,qsa = norm_gateway(fetch_via_gateway(cnpj))
-            if qsa: return raw,qsa,"gateway",errors
-        except Exception as e: errors["gateway"]=str(e)
-    try:
-        raw = fetch_brasilapi(cnpj); raw2,qsa = norm_brasilapi(raw)
-        if qsa or not try_alts: return raw2,qsa,"brasilapi",errors
+# Cadeia de provedores montada uma vez: a configuração do gateway não muda no processo
+PIPELINE = tuple(([("gateway", functools.partial(fetch_via_gateway, **GATEWAY_ARGS), norm_gateway)] if GATEWAY_URL and INTERNAL_API_KEY else [])
+                 + [("brasilapi", fetch_brasilapi, norm_brasilapi)])
+PIPELINE_ALTS = PIPELINE + (("receitaws", fetch_receitaws, norm_receitaws),)
+
+@st.cache_resource
+def hedge_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+
+def run_step(step: Tuple[str,Any,Any], cnpj: str, timeout: Tuple[float,float],
+             deadline: Optional[float]=None, ctx: Any=None) -> Any:
+    """Roda um provedor da cadeia; devolve (raw, qsa, erro) ou a exceção levantada.
+    `deadline` segue para o fetcher: a BrasilAPI desiste da fila do balde se a espera não couber no prazo.
+    Se o provedor falhar e houver resposta boa guardada (até STALE_TTL), usa essa e `erro` traz a falha."""
+    if ctx is not None: add_script_run_ctx(threading.current_thread(), ctx)
+    name,fetch,norm = step
+    try: return (*norm(fetch(cnpj, _timeout=timeout, _deadline=deadline)), None)
     except Exception as e:
-        errors["brasilapi"]=str(e); raw2,qsa={},[]
-    if try_alts:
-        try:
-            raw3,qsa2 = norm_receitaws(fetch_receitaws(cnpj))
-            if qsa2: return raw3,qsa2,"receitaws",errors
-        except Exception as e: errors["receitaws"]=str(e)
-    return raw2,qsa,"desconhecido",errors
+        stale = CACHE.get(stale_key(name, cnpj, **getattr(fetch, "keywords", {})))  # gateway: partial com GATEWAY_ARGS
+        return e if stale is None else (*norm(stale), str(e))
+
+def budget(timeout: Tuple[float,float], deadline: Optional[float]) -> Optional[Tuple[float,float]]:
+    """(connect, read) cortados ao que resta até `deadline`; None se o prazo já acabou."""
+    if deadline is None: return timeout
+    remaining = deadline - time.monotonic()
+    return (min(timeout[0], remaining), min(timeout[1], remaining)) if remaining > 0 else None
+
+def hedged_steps(primary: Tuple[str,Any,Any], backup: Tuple[str,Any,Any], cnpj: str,
+                 timeout: Tuple[float,float], deadline: float):
+    """Gera (nome, resultado) na ordem de chegada; `backup` só corre junto se `primary` passar de HEDGE_DELAY."""
+    pool = hedge_pool(); ctx = get_script_run_ctx()
+    t = budget(timeout, deadline) or (timeout[0], 0.01)  # _try_all acabou de checar o prazo
+    futs = {pool.submit(run_step, primary, cnpj, t, deadline, ctx): primary[0]}
+    if not wait(futs, timeout=HEDGE_DELAY).done and (t := budget(timeout, deadline)):
+        futs[pool.submit(run_step, backup, cnpj, t, deadline, ctx)] = backup[0]
+    for fut in as_completed(futs):
+        yield futs[fut], fut.result()
+    if len(futs) == 1:
+        t = budget(timeout, deadline)  # o primário já gastou parte do prazo
+        yield backup[0], run_step(backup, cnpj, t, deadline) if t else TimeoutError(DEADLINE_ERROR)
+
+@st.cache_resource
+def inflight_calls() -> Tuple[threading.Lock, Dict[Tuple[str,bool],Future]]:
+    # Consultas em andamento no processo (todas as sessões), por (cnpj, try_alts)
+    return threading.Lock(), {}
+
+def try_all(cnpj: str, try_alts: bool, timeout: Tuple[float,float]=HTTP_TIMEOUT,
+            hedge: bool=False)->Tuple[Dict[str,Any],List[Dict[str,Any]],str,Dict[str,str]]:
+    """Resolve o CNPJ pela cadeia de provedores; chamadas simultâneas para o mesmo CNPJ compartilham uma consulta."""
+    lock, calls = inflight_calls(); key = (cnpj, try_alts)
+    with lock:
+        fut = calls.get(key); owner = fut is None
+        if owner: fut = calls[key] = Future()
+    if not owner: return fut.result()
+    try:
+        res = _try_all(cnpj, try_alts, timeout, hedge); fut.set_result(res); return res
+    except BaseException as e:
+        fut.set_exception(e); raise
+    finally:
+        with lock: calls.pop(key, None)
+
+def _try_all(cnpj: str, try_alts: bool, timeout: Tuple[float,float],
+             hedge: bool)->Tuple[Dict[str,Any],List[Dict[str,Any]],str,Dict[str,str]]:
+    errors={}; results={}
+    pipeline = PIPELINE_ALTS if try_alts else PIPELINE
+    # Provedor que já respondeu com QSA para este CNPJ vai primeiro
+    preferred = CACHE.get(("pref", cnpj))  # mesma expiração/limite dos payloads a que se refere
+    if preferred and preferred != pipeline[0][0]:
+        pipeline = sorted(pipeline, key=lambda step: step[0] != preferred)
+    names = [step[0] for step in pipeline]
+    deadline = time.monotonic() + TRY_ALL_DEADLINE; i = 0
+    while i < len(pipeline):
+        t = budget(timeout, deadline)
+        if t is None:
+            for name,_,_ in pipeline[i:]: errors[name]=DEADLINE_ERROR
+            break
+        pair = pipeline[i:i+2]
+        # Gateway nunca entra no hedge (não queimar cota de bureau)
+        if hedge and {step[0] for step in pair} == HEDGE_PAIR:
+            outcomes = hedged_steps(pair[0], pair[1], cnpj, timeout, deadline); i+=2
+        else:
+            outcomes = [(pipeline[i][0], run_step(pipeline[i], cnpj, t, deadline))]; i+=1
+        for name,res in outcomes:
+            if isinstance(res, Exception):
+                errors[name]=str(res); continue
+            raw,qsa,err = res
+            if err: errors[name] = err  # falhou agora; a cópia guardada fica de reserva e a cascata segue
+            source = f"{name} (cache antigo)" if err else name
+            results[name] = raw,qsa,source
+            if qsa and not err:
+                # Vencer um hedge só por ser mais rápido não muda a preferência: todos os anteriores
+                # na cadeia precisam ter falhado ou vindo sem QSA (o lote não faz hedge e gastaria a cota do alternativo)
+                ahead = names[:names.index(name)]
+                if name != preferred and all(n in errors or n in results for n in ahead):
+                    CACHE.set(("pref", cnpj), name, expire=DISK_CACHE_TTL)
+                return raw,qsa,source,errors
+    # Ninguém respondeu agora com QSA: vale a primeira cópia antiga que tenha
+    for raw,qsa,source in results.values():
+        if qsa: return raw,qsa,source,errors
+    raw,qsa,source = results.get("brasilapi") or ({},[],"")
+    if try_alts or not source: source = "desconhecido"
+    return raw,qsa,source,errors
 
 # ========= UI =========
 
@@ -147,21 +447,44 @@ with st.sidebar:
     st.subheader("⚙️ Configurações")
     if GATEWAY_URL and INTERNAL_API_KEY:
         st.success("Gateway configurado"); st.write(f"**Gateway:** {GATEWAY_URL}")
-        use_bureau = st.checkbox("Consultar Bureau (via gateway)", value=False)
+        use_bureau = st.checkbox("Consultar Bureau (via gateway)", value=False,
+                                 help="Ex.: Serasa/Quod (requer contrato e credenciais configuradas no gateway).")
     else:
         st.info("Sem gateway configurado. Usando BrasilAPI pública."); use_bureau=False
     try_alts = st.checkbox("Tentar provedores alternativos se faltar QSA", value=ENABLE_ALT_PROVIDERS)
+    read_timeout = st.slider("Timeout de leitura por provedor (s)", 2, TRY_ALL_DEADLINE, HTTP_READ_TIMEOUT,
+                             help=f"Menor = cascata para o próximo provedor mais cedo quando um deles trava. "
+                                  f"A consulta inteira tem teto de {TRY_ALL_DEADLINE}s.")
+    timeout = (HTTP_CONNECT_TIMEOUT, read_timeout)
     st.markdown("---")
     mode = st.radio("Modos de consulta", ["Consulta única","Lote (CSV de CNPJs)"], index=0)
 
-def render_single(cnpj_input: str, try_alts: bool):
+def render_bureau(cnpj: str, timeout: Tuple[float,float]=HTTP_TIMEOUT):
+    st.markdown("---")
+    st.subheader("📊 Indicadores de Bureau (ex.: Serasa)")
+    try:
+        bureau = fetch_bureau_serasa(cnpj, _timeout=timeout, **GATEWAY_ARGS)
+    except Exception as e:
+        st.error(f"Erro consultando bureau: {e}"); return
+    if not bureau:
+        st.info("Nenhum retorno do bureau (endpoint não configurado ou sem dados)."); return
+    pend = bureau.get("pendencias") or bureau.get("debts")
+    qtd_pend = len(pend) if isinstance(pend, list) else (pend if isinstance(pend, int) else None)
+    st.write("**Score:**", bureau.get("score") if bureau.get("score") is not None else "—")
+    st.write("**Pendências (qtd.):**", qtd_pend if qtd_pend is not None else "—")
+    st.json(bureau)
+    st.caption("Obs.: o schema real do bureau depende do seu contrato. Padronize isso no gateway.")
+
+def render_single(cnpj_input: str, try_alts: bool, refresh: bool=False,
+                  timeout: Tuple[float,float]=HTTP_TIMEOUT, use_bureau: bool=False):
     d = only_digits(cnpj_input)
     if len(d)!=14:
         st.error("CNPJ inválido. Digite 14 dígitos (com ou sem máscara)."); return
+    if refresh: forget_cnpj(d)
     if not cnpj_is_valid(d):
         st.warning("Dígitos verificadores não batem. Tentando mesmo assim.")
     with st.spinner("Consultando dados..."):
-        raw,qsa,source,errors = try_all(d, try_alts)
+        raw,qsa,source,errors = try_all(d, try_alts, timeout, hedge=True)
 
     razao = raw.get("razao_social") or raw.get("nome_fantasia") or raw.get("nome") or "(sem razão social)"
     natureza = raw.get("natureza_juridica")
@@ -211,66 +534,116 @@ def render_single(cnpj_input: str, try_alts: bool):
         else:
             st.write("Não foi possível determinar a UF para direcionar a Junta.")
 
+    if use_bureau: render_bureau(d, timeout)
+
     with st.expander("Ver detalhes técnicos / JSON bruto"):
         if errors: st.write("**Erros por provedor**:", errors)
         st.write("**Raw (parcial)**:", raw)
 
-def render_batch(try_alts: bool):
+def batch_row(c: str, try_alts: bool, timeout: Tuple[float,float]=HTTP_TIMEOUT) -> Dict[str,Any]:
+    try:
+        raw,qsa,source,errors = try_all(c, try_alts, timeout)
+        est = raw.get("estabelecimento") or {}
+        uf = est.get("estado") or est.get("uf") or est.get("estado_nf") or ""
+        nature = raw.get("natureza_juridica"); code = str(raw.get("natureza_juridica_codigo") or "")
+        likely = extract_likely_signers(qsa)
+        poss = ", ".join([p["nome"] for p in likely if p.get("provavel_assinante")]) or ""
+        return {
+            "cnpj": cnpj_format(c),
+            "razao_social": raw.get("razao_social") or raw.get("nome_fantasia") or raw.get("nome") or "",
+            "uf": uf or "", "municipio": est.get("cidade") or est.get("municipio") or "",
+            "porte": raw.get("porte") or "", "entidade_publica": "sim" if is_public_entity(nature,code) else "nao",
+            "provaveis_assinantes": poss, "fonte": source, "junta_url": get_junta_url(uf),
+        }
+    except Exception as e:
+        return {"cnpj": cnpj_format(c), "erro": str(e)[:180]}
+
+def read_cnpj_chunks(file) -> Iterator[List[str]]:
+    """Lê o CSV em blocos de BATCH_CHUNK_ROWS linhas, só a coluna cnpj; gera listas de CNPJs com 14 dígitos."""
+    reader = pd.read_csv(file, dtype=str, usecols=lambda c: str(c).strip().lower() == "cnpj",
+                         engine="c", chunksize=BATCH_CHUNK_ROWS)
+    for chunk in reader:
+        if chunk.columns.empty: raise ValueError("CSV deve conter coluna 'cnpj'.")
+        digits = chunk.iloc[:, 0].dropna().str.replace(r"[^0-9]+", "", regex=True)
+        yield digits[digits.str.len().eq(14)].tolist()
+
+def render_batch(try_alts: bool, timeout: Tuple[float,float]=HTTP_TIMEOUT):
     st.write("Envie um **CSV** com coluna **cnpj** (com ou sem máscara).")
     file = st.file_uploader("CSV com CNPJs", type=["csv"])
     if not file: return
+
+    # Linhas vão direto para o CSV, na ordem de entrada; só as últimas ficam na prévia.
+    # Cada CNPJ é consultado uma vez; duplicados (mesmo em blocos diferentes) reaproveitam o resultado,
+    # por isso `results` guarda uma linha por CNPJ único até o fim do lote.
+    buf = io.StringIO(); writer = csv.DictWriter(buf, fieldnames=BATCH_COLUMNS); writer.writeheader()
+    recent = deque(maxlen=BATCH_PREVIEW_ROWS); results = {}
+    notes=st.container(); prog=st.progress(0); table=st.empty()
+    # Progresso por linhas: o parser C lê o upload inteiro no 1º bloco, então file.tell() não serve.
+    # Total estimado pelas quebras de linha (menos o cabeçalho); cada bloco são BATCH_CHUNK_ROWS linhas.
+    total_rows = max(file.getvalue().count(b"\n") - 1, 1); pos = 0
+    n_read = n_invalid = n_queries = 0; last_prog = 0.0
+    # Sem `with`: Stop/novo upload chegam como exceção do Streamlit, e shutdown(wait=True) prenderia o
+    # rerun até a fila inteira terminar, gastando cota. No finally, o que ainda não começou é cancelado.
+    ex = ThreadPoolExecutor(max_workers=BATCH_WORKERS, initializer=add_script_run_ctx,
+                            initargs=(None, get_script_run_ctx()))
     try:
-        df = pd.read_csv(file, dtype=str)
-    except Exception as e:
+        for cnpjs in read_cnpj_chunks(file):
+            n_read += len(cnpjs)
+            if not cnpjs:
+                pos += BATCH_CHUNK_ROWS; continue
+            # DV inválido vira linha de erro sem gastar nenhuma chamada HTTP
+            valid = cnpj_is_valid_batch(cnpj_digit_matrix(cnpjs))
+            for c in (c for c,ok in zip(cnpjs, valid) if not ok and c not in results):
+                results[c] = {"cnpj": cnpj_format(c), "erro": INVALID_DV_ERROR}; n_invalid += 1
+            futures = {ex.submit(batch_row, c, try_alts, timeout): c
+                       for c in dict.fromkeys(cnpjs) if c not in results}
+            n_queries += len(futures)
+            end = min(pos + BATCH_CHUNK_ROWS, total_rows); next_i = 0
+            for done,fut in enumerate(as_completed(futures), start=1):
+                results[futures[fut]] = fut.result()
+                while next_i < len(cnpjs) and cnpjs[next_i] in results:
+                    row = results[cnpjs[next_i]]; writer.writerow(row); recent.append(row); next_i+=1
+                if (now := time.monotonic()) - last_prog >= BATCH_PROGRESS_EVERY:
+                    prog.progress(min((pos + (end-pos)*done/len(futures))/total_rows, 1.0),
+                                  text=f"{n_queries - len(futures) + done} consultas concluídas"); last_prog = now
+                if done % BATCH_REFRESH_EVERY == 0:
+                    table.dataframe(pd.DataFrame(recent, columns=BATCH_COLUMNS).fillna(""), use_container_width=True)
+            for c in cnpjs[next_i:]:   # bloco só com CNPJs já vistos: nada foi submetido
+                row = results[c]; writer.writerow(row); recent.append(row)
+            pos = end
+    except ValueError as e:
         st.error(f"Erro ao ler CSV: {e}"); return
-    if "cnpj" not in df.columns:
-        st.error("CSV deve conter coluna 'cnpj'."); return
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
+    prog.progress(1.0, text=f"{n_queries} consultas concluídas")
 
-    cnpjs = [only_digits(x) for x in df["cnpj"].fillna("").astype(str).tolist()]
-    cnpjs = [c for c in cnpjs if len(c)==14]
-    if not cnpjs:
+    if not n_read:
         st.error("Nenhum CNPJ válido (14 dígitos) encontrado."); return
-
-    rows=[]; prog=st.progress(0); total=len(cnpjs)
-    for i,c in enumerate(cnpjs, start=1):
-        try:
-            raw,qsa,source,errors = try_all(c, try_alts)
-            est = raw.get("estabelecimento") or {}
-            uf = est.get("estado") or est.get("uf") or est.get("estado_nf") or ""
-            nature = raw.get("natureza_juridica"); code = str(raw.get("natureza_juridica_codigo") or "")
-            likely = extract_likely_signers(qsa)
-            poss = ", ".join([p["nome"] for p in likely if p.get("provavel_assinante")]) or ""
-            rows.append({
-                "cnpj": cnpj_format(c),
-                "razao_social": raw.get("razao_social") or raw.get("nome_fantasia") or raw.get("nome") or "",
-                "uf": uf or "", "municipio": est.get("cidade") or est.get("municipio") or "",
-                "porte": raw.get("porte") or "", "entidade_publica": "sim" if is_public_entity(nature,code) else "nao",
-                "provaveis_assinantes": poss, "fonte": source, "junta_url": get_junta_url(uf),
-            })
-        except Exception as e:
-            rows.append({"cnpj": cnpj_format(c), "erro": str(e)[:180]})
-        prog.progress(i/total)
-    out = pd.DataFrame(rows)
-    st.dataframe(out, use_container_width=True)
-    st.download_button("Baixar resultados (CSV)", out.to_csv(index=False).encode("utf-8-sig"),
+    if n_invalid:
+        notes.warning(f"{n_invalid} CNPJ(s) com dígitos verificadores inválidos (marcados na coluna erro, sem consulta).")
+    if len(results) < n_read:
+        notes.caption(f"{n_read-len(results)} CNPJs duplicados, {n_queries} consultas únicas")
+    # Tela mostra só a prévia limitada; o resultado completo sai do buffer, sem virar DataFrame
+    table.dataframe(pd.DataFrame(recent, columns=BATCH_COLUMNS).fillna(""), use_container_width=True)
+    if len(recent) == recent.maxlen:
+        notes.caption(f"Prévia com as últimas {BATCH_PREVIEW_ROWS} linhas; o CSV traz todas.")
+    st.download_button("Baixar resultados (CSV)", buf.getvalue().encode("utf-8-sig"),
                        file_name="resultado_cnpjs.csv", mime="text/csv")
 
 # ========= Main =========
 st.title(APP_TITLE)
 st.caption(APP_CAPTION)
 
-if 'mode' not in st.session_state:
-    st.session_state.mode = mode  # pega do sidebar
-
 if mode == "Consulta única":
     with st.form("consulta_unica"):
         cnpj_input = st.text_input("Digite o CNPJ", placeholder="00.000.000/0001-00",
                                    help="Aceita com ou sem pontuação.")
         submitted = st.form_submit_button("Consultar")
-    if submitted:
-        render_single(cnpj_input, try_alts=try_alts)
+        refresh = st.form_submit_button("Forçar refresh", help="Ignora o cache e consulta os provedores novamente.")
+    if submitted or refresh:
+        render_single(cnpj_input, try_alts=try_alts, refresh=refresh, timeout=timeout, use_bureau=use_bureau)
 else:
-    render_batch(try_alts=try_alts)
+    render_batch(try_alts=try_alts, timeout=timeout)
 
 st.markdown("---")
 st.caption("Aviso: A identificação de **quem assina** depende do contrato social/estatuto, das últimas alterações e de eventuais procurações. "